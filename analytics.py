@@ -0,0 +1,148 @@
+from collections import Counter
+
+from extensions import db
+from models import (Book, Chapter, ReadingEvent, ReaderChapter, ReaderBook, ReaderBookDay, ReaderDay,
+                    BookStats, BookDayStats, ChapterStats, DailyStats, RollupState)
+
+ROLLUP_NAME = 'reading_events'
+# SQLite's bound-parameter limit (999 before 3.32) covers a whole statement, and
+# the widest marker key, (user_id, book_id, day), puts three IN lists of up to
+# one batch each into a single query: 3 * 300 stays under it.
+ROLLUP_BATCH_SIZE = 300
+
+
+def record_chapter_read(user_id, book_id, chapter_id):
+    """Append a read to the event log. The caller commits."""
+    db.session.add(ReadingEvent(user_id=user_id, book_id=book_id, chapter_id=chapter_id))
+
+
+def rollup_reading_events(batch_size=ROLLUP_BATCH_SIZE):
+    """Fold events logged since the last run into the stats tables.
+
+    Each batch commits its aggregates together with the new cursor position,
+    so an interrupted run never counts an event twice. Returns the number of
+    events folded.
+    """
+    if RollupState.query.get(ROLLUP_NAME) is None:
+        db.session.add(RollupState(name=ROLLUP_NAME, last_event_id=0))
+        db.session.commit()
+
+    total = 0
+    while True:
+        folded = _rollup_batch(batch_size)
+        total += folded
+        if folded < batch_size:
+            return total
+
+
+def _rollup_batch(batch_size):
+    cursor = db.session.query(RollupState.last_event_id).filter_by(name=ROLLUP_NAME).scalar()
+    events = db.session.query(ReadingEvent.id, ReadingEvent.user_id, ReadingEvent.book_id,
+                              ReadingEvent.chapter_id, ReadingEvent.created_at)\
+        .filter(ReadingEvent.id > cursor)\
+        .order_by(ReadingEvent.id)\
+        .limit(batch_size).all()
+    if not events:
+        return 0
+
+    # Claim the batch first: this takes SQLite's write lock, and a concurrent
+    # rollup that already moved the cursor makes the update match nothing.
+    claimed = RollupState.query.filter_by(name=ROLLUP_NAME, last_event_id=cursor)\
+        .update({'last_event_id': events[-1].id}, synchronize_session=False)
+    if not claimed:
+        db.session.rollback()
+        return 0
+
+    new_chapter_readers = _first_seen(ReaderChapter, ('user_id', 'chapter_id'),
+                                      {(e.user_id, e.chapter_id) for e in events})
+    new_readers = _first_seen(ReaderBook, ('user_id', 'book_id'),
+                              {(e.user_id, e.book_id) for e in events})
+    new_book_readers = _first_seen(ReaderBookDay, ('user_id', 'book_id', 'day'),
+                                   {(e.user_id, e.book_id, e.created_at.date()) for e in events})
+    new_active_readers = _first_seen(ReaderDay, ('user_id', 'day'),
+                                     {(e.user_id, e.created_at.date()) for e in events})
+
+    _increment(BookStats, ('book_id',), {
+        'reads': Counter((e.book_id,) for e in events),
+        'readers': Counter((book_id,) for _, book_id in new_readers),
+    })
+    _increment(BookDayStats, ('book_id', 'day'), {
+        'reads': Counter((e.book_id, e.created_at.date()) for e in events),
+        'readers': Counter((book_id, day) for _, book_id, day in new_book_readers),
+    })
+    chapter_books = {e.chapter_id: e.book_id for e in events}
+    _increment(ChapterStats, ('chapter_id', 'book_id'), {
+        'reads': Counter((e.chapter_id, e.book_id) for e in events),
+        'readers': Counter((chapter_id, chapter_books[chapter_id]) for _, chapter_id in new_chapter_readers),
+    })
+    _increment(DailyStats, ('day',), {
+        'reads': Counter((e.created_at.date(),) for e in events),
+        'active_readers': Counter((day,) for _, day in new_active_readers),
+    })
+
+    db.session.commit()
+    return len(events)
+
+
+def _filter_keys(model, columns, keys):
+    query = model.query
+    for i, column in enumerate(columns):
+        query = query.filter(getattr(model, column).in_({key[i] for key in keys}))
+    return query
+
+
+def _first_seen(model, columns, keys):
+    """Insert the marker rows in `keys` that don't exist yet and return those keys."""
+    existing = {tuple(getattr(row, c) for c in columns) for row in _filter_keys(model, columns, keys)}
+    new_keys = keys - existing
+    db.session.add_all([model(**dict(zip(columns, key))) for key in new_keys])
+    return new_keys
+
+
+def _increment(model, columns, counters):
+    """Add each Counter in `counters` to the same-named column, creating rows as needed."""
+    keys = set().union(*counters.values())
+    rows = {tuple(getattr(row, c) for c in columns): row for row in _filter_keys(model, columns, keys)}
+    for key in keys:
+        row = rows.get(key)
+        if row is None:
+            row = model(**dict(zip(columns, key)), **{field: 0 for field in counters})
+            db.session.add(row)
+        for field, counter in counters.items():
+            setattr(row, field, getattr(row, field) + counter[key])
+
+
+def book_readers():
+    """Distinct readers and chapter reads for every book, most-read first."""
+    readers = db.func.coalesce(BookStats.readers, 0)
+    rows = db.session.query(Book.id, Book.title, readers.label('readers'),
+                            db.func.coalesce(BookStats.reads, 0).label('reads'))\
+        .outerjoin(BookStats, BookStats.book_id == Book.id)\
+        .order_by(readers.desc(), Book.title).all()
+    return [{'book_id': row.id, 'title': row.title, 'readers': row.readers, 'reads': row.reads} for row in rows]
+
+
+def chapter_funnel(book_id):
+    """Readers per chapter of a book, in reading order, with drop-off from the previous chapter."""
+    rows = db.session.query(Chapter.id, Chapter.chapter_number, Chapter.title,
+                            ChapterStats.readers, ChapterStats.reads)\
+        .outerjoin(ChapterStats, ChapterStats.chapter_id == Chapter.id)\
+        .filter(Chapter.book_id == book_id)\
+        .order_by(Chapter.chapter_number).all()
+
+    funnel = []
+    first = previous = None
+    for row in rows:
+        readers = row.readers or 0
+        if first is None:
+            first = readers
+        funnel.append({
+            'chapter_number': row.chapter_number,
+            'title': row.title,
+            'readers': readers,
+            'reads': row.reads or 0,
+            'percent_of_start': round(readers * 100 / first) if first else 0,
+            'drop_off': (previous - readers) if previous is not None else 0,
+        })
+        previous = readers
+    return funnel
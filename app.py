@@ -1,14 +1,23 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, send_from_directory, send_file
+from flask import Flask, Request, render_template, redirect, url_for, request, flash, jsonify, send_from_directory, send_file, make_response
 from werkzeug.utils import secure_filename
 import os
 import shutil
 from datetime import datetime, timedelta
 from extensions import db
-from models import Book, Chapter, Review, User, ReadingProgress
+from models import Book, Chapter, ChapterRevision, Review, User, ReadingProgress, BookDayStats, DailyStats, rebuild_chapter_index
+from sqlalchemy.orm import contains_eager, joinedload
 from itsdangerous import URLSafeTimedSerializer
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from functools import wraps
 from flask_mail import Mail, Message
+from snapshots import SnapshotStore, SnapshotError
+from analytics import record_chapter_read, rollup_reading_events, book_readers, chapter_funnel
+from revisions import (RevisionConflict, InvalidDelta, current_revision, diff_text, normalize_newlines,
+                       save_content, rebuild)
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from db_restore import RestoreError, GenerationWatcher, validate_database, swap_database
+import tempfile
 
 
 
@@ -26,20 +35,64 @@ mail = Mail(app)
 app.secret_key = os.urandom(24)
 instance_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
 os.makedirs(instance_path, exist_ok=True)
+database_path = os.path.join(instance_path, 'books.db')
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(instance_path, 'books.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database_path
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
 app.config['UPLOAD_FOLDER'] = os.path.join(app.static_folder, 'images', 'covers')
 app.config['BACKUP_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups')
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024
+# Database uploads to restore_database may be larger than any other form.
+app.config['RESTORE_MAX_CONTENT_LENGTH'] = 512 * 1024 * 1024
+# Grandfather-father-son retention: every backup from the last day, then the
+# newest backup per day / ISO week / month.
+app.config['BACKUP_RETENTION'] = {'recent_hours': 24, 'daily': 7, 'weekly': 4, 'monthly': 12}
 
 
 
+class AppRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # A restore upload is parsed straight into instance/, where it is
+        # validated and swapped in, instead of into a spool file copied later.
+        if self.endpoint == 'restore_database':
+            upload = tempfile.NamedTemporaryFile(dir=instance_path, suffix='.restore', delete=False)
+            self.restore_uploads.append(upload.name)
+            return upload
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+    @property
+    def restore_uploads(self):
+        if not hasattr(self, '_restore_uploads'):
+            self._restore_uploads = []
+        return self._restore_uploads
+
+app.request_class = AppRequest
+
 db.init_app(app)
 mail = Mail(app)
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['BACKUP_FOLDER'], exist_ok=True)
+snapshot_store = SnapshotStore(os.path.join(app.config['BACKUP_FOLDER'], 'snapshots'))
+
+# Bumped by every restore; each worker drops its pooled connections when it changes.
+generation_watcher = GenerationWatcher(database_path)
+
+@app.before_request
+def dispose_stale_connections():
+    generation_watcher.check(db.engine)
+
+def upgrade_database():
+    """Create tables added since the database file was made, so an existing books.db keeps working."""
+    existing = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    if 'chapter_ordinal' not in existing:
+        for (book_id,) in db.session.query(Book.id).all():
+            rebuild_chapter_index(book_id)
+        db.session.commit()
+
+with app.app_context():
+    upgrade_database()
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -68,6 +121,10 @@ def head_required(f):
     return decorated_function
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+RESTORE_REQUIRED_TABLES = ('book', 'chapter', 'user', 'review', 'reading_progress')
+PROFILE_BOOKS_PER_PAGE = 10
+ANALYTICS_DAYS = 14
+OFFLINE_CHAPTERS_AHEAD = 3
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -132,6 +189,10 @@ def register():
         return redirect(url_for('login'))
     return render_template('login.html', register_mode=True) 
 
+# asgi.py serves home, book_page and read_chapter itself under uvicorn, with
+# every column of the models these views pass but none of their relationships
+# beyond book.chapters. A template change that needs another relationship or
+# query has to be made there too.
 @app.route('/')
 def home():
     books = Book.query.order_by(Book.created_at.desc()).all()
@@ -143,8 +204,9 @@ def book_page(book_id):
     user_progress = None
     if current_user.is_authenticated:
         user_progress = ReadingProgress.query.filter_by(user_id=current_user.id, book_id=book.id).first()
+    reviews = book.reviews.filter_by(approved=True).order_by(Review.created_at.desc()).all()
         
-    return render_template('book_page.html', book=book, Review=Review, progress=user_progress)
+    return render_template('book_page.html', book=book, reviews=reviews, progress=user_progress)
 @app.route('/shutdown')
 def shutdown():
     archive_path = os.path.join('static', 'images', 'dev_archive')
@@ -166,24 +228,65 @@ def test_email():
     except Exception as e:
         return f"Error sending email: {str(e)}"
 
+def chapter_links(book_id, next_chapter):
+    links = [f"<{url_for('static', filename='css/styles.css')}>; rel=preload; as=style"]
+    if next_chapter:
+        links.append(f"<{url_for('read_chapter', book_id=book_id, chapter_id=next_chapter.id)}>; rel=prefetch")
+    return links
+
+def record_progress(user_id, book_id, chapter_id):
+    progress = ReadingProgress.query.filter_by(user_id=user_id, book_id=book_id).first()
+    if not progress:
+        progress = ReadingProgress(user_id=user_id, book_id=book_id, chapter_id=chapter_id)
+        db.session.add(progress)
+    else:
+        progress.chapter_id = chapter_id
+        progress.last_read_at = datetime.utcnow()
+    record_chapter_read(user_id, book_id, chapter_id)
+    db.session.commit()
+
+def render_chapter(book, chapter, prev_chapter, upcoming):
+    """Chapter page response. Shared with the async read path in asgi.py."""
+    next_chapter = upcoming[0] if upcoming else None
+    # The worker skips fetching the chapter the Link header already prefetches.
+    offline_chapters = [{'url': url_for('read_chapter', book_id=book.id, chapter_id=c.id),
+                         'version': c.updated_at.isoformat(), 'prefetched': c is next_chapter}
+                        for c in [chapter, *upcoming]]
+    response = make_response(render_template('read_chapter.html', book=book, chapter=chapter, prev_chapter=prev_chapter,
+                                             next_chapter=next_chapter, offline_chapters=offline_chapters))
+    response.headers['Link'] = ', '.join(chapter_links(book.id, next_chapter))
+    # The service worker compares this with the page's offline_chapters to refresh stale copies.
+    response.headers['X-Chapter-Version'] = chapter.updated_at.isoformat()
+    return response
+
 @app.route('/books/<int:book_id>/chapters/<int:chapter_id>')
 def read_chapter(book_id, chapter_id):
     book = Book.query.get_or_404(book_id)
     chapter = Chapter.query.get_or_404(chapter_id)
-    
-    if current_user.is_authenticated:
-        progress = ReadingProgress.query.filter_by(user_id=current_user.id, book_id=book_id).first()
-        if not progress:
-            progress = ReadingProgress(user_id=current_user.id, book_id=book_id, chapter_id=chapter_id)
-            db.session.add(progress)
-        else:
-            progress.chapter_id = chapter_id
-            progress.last_read_at = datetime.utcnow()
-        db.session.commit()
+
+    upcoming = db.session.query(Chapter.id, Chapter.updated_at)\
+        .filter(Chapter.book_id == book_id, Chapter.chapter_number > chapter.chapter_number)\
+        .order_by(Chapter.chapter_number.asc())\
+        .limit(OFFLINE_CHAPTERS_AHEAD).all()
+
+    # Servers that support it (e.g. gunicorn) send these as 103 Early Hints.
+    early_hints = request.environ.get('wsgi.early_hints')
+    if early_hints:
+        early_hints([('Link', link) for link in chapter_links(book_id, upcoming[0] if upcoming else None)])
 
     prev_chapter = Chapter.query.filter(Chapter.book_id == book_id, Chapter.chapter_number < chapter.chapter_number).order_by(Chapter.chapter_number.desc()).first()
-    next_chapter = Chapter.query.filter(Chapter.book_id == book_id, Chapter.chapter_number > chapter.chapter_number).order_by(Chapter.chapter_number.asc()).first()
-    return render_template('read_chapter.html', book=book, chapter=chapter, prev_chapter=prev_chapter, next_chapter=next_chapter)
+    return render_chapter(book, chapter, prev_chapter, upcoming)
+
+# Posted by the chapter page once it is shown, rather than recorded on GET, so
+# prefetches aren't counted and pages served from a cache still are.
+@app.route('/books/<int:book_id>/chapters/<int:chapter_id>/progress', methods=['POST'])
+def record_reading_progress(book_id, chapter_id):
+    chapter = Chapter.query.get_or_404(chapter_id)
+    if chapter.book_id != book_id:
+        return '', 404
+    if current_user.is_authenticated:
+        record_progress(current_user.id, book_id, chapter_id)
+    return '', 204
 
 @app.route('/books/<int:book_id>/review', methods=['GET', 'POST'])
 @login_required
@@ -269,6 +372,8 @@ def edit_book(book_id):
 def delete_book(book_id):
     book = Book.query.get_or_404(book_id)
     db.session.delete(book)
+    db.session.flush()
+    rebuild_chapter_index(book_id)
     db.session.commit()
     flash('Book deleted.', 'success')
     return redirect(url_for('admin_panel'))
@@ -284,13 +389,40 @@ def manage_chapters(book_id):
 def add_chapter(book_id):
     chapter_number = request.form.get('chapter_number')
     title = request.form.get('title')
-    content = request.form.get('content')
+    content = normalize_newlines(request.form.get('content'))
     new_chapter = Chapter(book_id=book_id, chapter_number=chapter_number, title=title, content=content)
     db.session.add(new_chapter)
+    db.session.flush()
+    rebuild_chapter_index(book_id)
     db.session.commit()
     flash('Chapter added.', 'success')
     return redirect(url_for('manage_chapters', book_id=book_id))
 
+@app.route('/admin/analytics')
+@admin_required
+def admin_analytics():
+    books = Book.query.order_by(Book.title).all()
+    book_id = request.args.get('book_id', type=int)
+    book = next((b for b in books if b.id == book_id), books[0] if books else None)
+
+    daily = DailyStats.query.order_by(DailyStats.day.desc()).limit(ANALYTICS_DAYS).all()
+    readers_per_book = book_readers()
+    book_days = []
+    funnel = []
+    if book:
+        book_days = BookDayStats.query.filter_by(book_id=book.id)\
+            .order_by(BookDayStats.day.desc()).limit(ANALYTICS_DAYS).all()
+        funnel = chapter_funnel(book.id)
+    return render_template('admin_analytics.html', books=books, book=book,
+                           daily=daily, readers_per_book=readers_per_book, book_days=book_days, funnel=funnel)
+
+@app.route('/admin/analytics/rollup', methods=['POST'])
+@admin_required
+def rollup_analytics():
+    folded = rollup_reading_events()
+    flash(f'Analytics updated with {folded} new reading event(s).', 'success')
+    return redirect(url_for('admin_analytics', book_id=request.form.get('book_id')))
+
 @app.route('/admin/reviews')
 @admin_required
 def admin_reviews():
@@ -385,17 +517,20 @@ def delete_user(user_id):
 @head_required
 def backup_database():
     if request.method == 'POST':
-        db_path = os.path.join(instance_path, 'books.db')
-        backup_filename = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        backup_path = os.path.join(app.config['BACKUP_FOLDER'], backup_filename)
         try:
-            shutil.copy2(db_path, backup_path)
-            flash(f'Backup created: {backup_filename}', 'success')
+            manifest = snapshot_store.create(database_path)
+            removed = snapshot_store.prune(**app.config['BACKUP_RETENTION'])
+            flash(f"Backup created: {manifest['name']} ({manifest['new_bytes'] // 1024} KB of new data)", 'success')
+            if removed:
+                flash(f"Pruned {len(removed)} old backup(s).", 'info')
         except Exception as e:
             flash(f'Error: {e}', 'danger')
         return redirect(url_for('backup_database'))
-    backups = sorted(os.listdir(app.config['BACKUP_FOLDER']), reverse=True)
-    return render_template('admin_backup.html', backups=backups)
+    snapshots = snapshot_store.list()
+    # Full-copy .db backups from before the snapshot store are still restorable.
+    legacy_backups = sorted((f for f in os.listdir(app.config['BACKUP_FOLDER']) if f.endswith('.db')), reverse=True)
+    return render_template('admin_backup.html', snapshots=snapshots, backups=legacy_backups,
+                           store_size=snapshot_store.disk_usage())
 
 @app.route('/download/database')
 @head_required
@@ -428,54 +563,102 @@ def profile():
         flash('Profile details updated successfully.', 'success')
         return redirect(url_for('profile'))
 
+    # Book, chapter and chapter position come back in the same row, so the
+    # template never lazy-loads per item. Only the chapter's number is shown,
+    # so its content is left out. Progress on a since-deleted chapter is kept.
+    page = request.args.get('page', 1, type=int)
     my_books = ReadingProgress.query.filter_by(user_id=current_user.id)\
-        .order_by(ReadingProgress.last_read_at.desc()).all()
-    
+        .join(ReadingProgress.book)\
+        .outerjoin(ReadingProgress.chapter)\
+        .outerjoin(Chapter.ordinal)\
+        .options(contains_eager(ReadingProgress.book),
+                 contains_eager(ReadingProgress.chapter).load_only(Chapter.id, Chapter.book_id, Chapter.chapter_number),
+                 contains_eager(ReadingProgress.chapter).contains_eager(Chapter.ordinal))\
+        .order_by(ReadingProgress.last_read_at.desc())\
+        .paginate(page=page, per_page=PROFILE_BOOKS_PER_PAGE, error_out=False)
+    if my_books.pages and page > my_books.pages:
+        return redirect(url_for('profile', page=my_books.pages))
+
     my_reviews = Review.query.filter_by(user_id=current_user.id)\
+        .options(joinedload(Review.book))\
         .order_by(Review.created_at.desc()).all()
 
     return render_template('profile.html', my_books=my_books, my_reviews=my_reviews)
 
+def restore_temp_path():
+    fd, path = tempfile.mkstemp(dir=instance_path, suffix='.restore')
+    os.close(fd)
+    return path
+
+def install_database(path):
+    """Check a candidate database file and swap it in for the live one. Always consumes `path`."""
+    try:
+        validate_database(path, db.metadata, RESTORE_REQUIRED_TABLES)
+        db.session.remove()
+        swap_database(path, database_path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    generation_watcher.check(db.engine)
+    # Older backups may predate the chapter position index.
+    for (book_id,) in db.session.query(Book.id).all():
+        rebuild_chapter_index(book_id)
+    db.session.commit()
+
 @app.route('/admin/restore_from_list/<string:filename>', methods=['POST'])
 @head_required
 def restore_from_list(filename):
-    backup_path = os.path.join(app.config['BACKUP_FOLDER'], filename)
-    db_path = os.path.join(instance_path, 'books.db')
-
-    if not os.path.exists(backup_path):
-        flash('Backup file not found.', 'danger')
-        return redirect(url_for('backup_database'))
+    if filename.endswith('.db'):
+        backup_path = os.path.join(app.config['BACKUP_FOLDER'], secure_filename(filename))
+        if not os.path.exists(backup_path):
+            flash('Backup file not found.', 'danger')
+            return redirect(url_for('backup_database'))
 
+    temp_path = restore_temp_path()
     try:
-        db.session.remove()
-        
-        shutil.copy2(backup_path, db_path)
+        if filename.endswith('.db'):
+            shutil.copyfile(backup_path, temp_path)
+        else:
+            snapshot_store.restore(filename, temp_path)
+        install_database(temp_path)
         flash(f'Successfully restored database from {filename}.', 'success')
+    except (SnapshotError, RestoreError) as e:
+        flash(str(e), 'danger')
     except Exception as e:
         flash(f'Error restoring database: {e}', 'danger')
-    
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
     return redirect(url_for('backup_database'))
 
 @app.route('/admin/restore', methods=['POST'])
 @head_required
 def restore_database():
-    if request.method == 'POST':
+    # Set before the form is parsed, which is when the limit is enforced.
+    request.max_content_length = app.config['RESTORE_MAX_CONTENT_LENGTH']
+    try:
         backup_file = request.files.get('backup_file')
-        
+
         if backup_file and backup_file.filename.endswith('.db'):
-            db_path = os.path.join(instance_path, 'books.db')
-            
             try:
-                db.session.remove()
-                backup_file.save(db_path)
+                backup_file.stream.close()
+                install_database(backup_file.stream.name)
                 flash('Successfully restored database from backup.', 'success')
+            except RestoreError as e:
+                flash(str(e), 'danger')
             except Exception as e:
                 flash(f'Error restoring database: {e}', 'danger')
-                
+
             return redirect(url_for('backup_database'))
         else:
             flash('Invalid file. Please upload a .db backup file.', 'danger')
-            
+    finally:
+        # install_database consumes the file it is given; drop any other parts.
+        for path in request.restore_uploads:
+            if os.path.exists(path):
+                os.remove(path)
+
     return redirect(url_for('backup_database'))
 
 @app.route('/admin/books/<int:book_id>/chapters/<int:chapter_id>', methods=['GET'])
@@ -489,9 +672,68 @@ def get_chapter(book_id, chapter_id):
         'id': chapter.id,
         'chapter_number': chapter.chapter_number,
         'title': chapter.title,
-        'content': chapter.content
+        'content': normalize_newlines(chapter.content),
+        'revision': current_revision(chapter.id)
     })
 
+@app.route('/admin/books/<int:book_id>/chapters/<int:chapter_id>', methods=['PATCH'])
+@admin_required
+def patch_chapter(book_id, chapter_id):
+    chapter = Chapter.query.get_or_404(chapter_id)
+    if chapter.book_id != book_id:
+        return jsonify({'error': 'Chapter not found for this book'}), 404
+
+    data = request.get_json(silent=True) or {}
+    base_revision = data.get('base_revision')
+    if not isinstance(base_revision, int) or isinstance(base_revision, bool):
+        return jsonify({'error': 'base_revision is required'}), 400
+    if 'title' in data and not (isinstance(data['title'], str) and data['title'].strip()):
+        return jsonify({'error': 'title must be a non-empty string'}), 400
+    if 'chapter_number' in data:
+        number = data['chapter_number']
+        if not isinstance(number, int) or isinstance(number, bool) or number < 1:
+            return jsonify({'error': 'chapter_number must be a positive integer'}), 400
+
+    try:
+        revision = save_content(chapter, base_revision, data.get('ops', []), user_id=current_user.id)
+        if 'title' in data:
+            chapter.title = data['title']
+        if 'chapter_number' in data:
+            chapter.chapter_number = data['chapter_number']
+            db.session.flush()
+            rebuild_chapter_index(book_id)
+        db.session.commit()
+    except RevisionConflict as e:
+        return jsonify({'error': str(e), 'revision': e.current}), 409
+    except InvalidDelta as e:
+        return jsonify({'error': str(e)}), 400
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Chapter was changed elsewhere or the chapter number is taken.',
+                        'revision': current_revision(chapter_id)}), 409
+
+    return jsonify({'revision': revision, 'updated_at': chapter.updated_at.isoformat()})
+
+@app.route('/admin/books/<int:book_id>/chapters/<int:chapter_id>/revisions')
+@admin_required
+def chapter_revisions(book_id, chapter_id):
+    chapter = Chapter.query.get_or_404(chapter_id)
+    if chapter.book_id != book_id:
+        return jsonify({'error': 'Chapter not found for this book'}), 404
+    revisions = ChapterRevision.query.filter_by(chapter_id=chapter.id).order_by(ChapterRevision.revision.desc()).all()
+    return jsonify([revision.to_dict() for revision in revisions])
+
+@app.route('/admin/books/<int:book_id>/chapters/<int:chapter_id>/revisions/<int:revision>')
+@admin_required
+def chapter_revision(book_id, chapter_id, revision):
+    chapter = Chapter.query.get_or_404(chapter_id)
+    if chapter.book_id != book_id:
+        return jsonify({'error': 'Chapter not found for this book'}), 404
+    content = rebuild(chapter.id, revision)
+    if content is None:
+        return jsonify({'error': 'Revision not found'}), 404
+    return jsonify({'id': chapter.id, 'revision': revision, 'content': content})
+
 @app.route('/admin/books/<int:book_id>/chapters/<int:chapter_id>/edit', methods=['POST'])
 @admin_required
 def edit_chapter(book_id, chapter_id):
@@ -500,11 +742,27 @@ def edit_chapter(book_id, chapter_id):
         flash('Invalid chapter.', 'danger')
         return redirect(url_for('manage_chapters', book_id=book_id))
 
+    base_revision = request.form.get('base_revision', type=int)
+    if base_revision is None:
+        flash('Missing chapter revision. Please reopen the chapter and try again.', 'danger')
+        return redirect(url_for('manage_chapters', book_id=book_id))
+
     chapter.chapter_number = request.form.get('chapter_number')
     chapter.title = request.form.get('title')
-    chapter.content = request.form.get('content')
-    
-    db.session.commit()
+    ops = diff_text(normalize_newlines(chapter.content), normalize_newlines(request.form.get('content')))
+    try:
+        save_content(chapter, base_revision, ops, user_id=current_user.id)
+        db.session.flush()
+        rebuild_chapter_index(book_id)
+        db.session.commit()
+    except RevisionConflict as e:
+        db.session.rollback()
+        flash(f'Chapter was edited elsewhere (now at revision {e.current}). Your changes were not saved.', 'danger')
+        return redirect(url_for('manage_chapters', book_id=book_id))
+    except IntegrityError:
+        db.session.rollback()
+        flash('Chapter was changed elsewhere or the chapter number is taken. Your changes were not saved.', 'danger')
+        return redirect(url_for('manage_chapters', book_id=book_id))
     flash('Chapter updated successfully!', 'success')
     return redirect(url_for('manage_chapters', book_id=book_id))
 
@@ -517,6 +775,8 @@ def delete_chapter(book_id, chapter_id):
         return redirect(url_for('manage_chapters', book_id=book_id))
         
     db.session.delete(chapter)
+    db.session.flush()
+    rebuild_chapter_index(book_id)
     db.session.commit()
     flash('Chapter deleted successfully!', 'success')
     return redirect(url_for('manage_chapters', book_id=book_id))
@@ -549,6 +809,13 @@ def change_password():
     return render_template('change_password.html')
 
 
+@app.route('/sw.js')
+def service_worker():
+    # Served from the site root so the worker's scope covers every page.
+    response = send_from_directory(os.path.join(app.static_folder, 'js'), 'sw.js', mimetype='application/javascript')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/sitemap.xml')
 def sitemap():
     return send_file('sitemap.xml', mimetype='application/xml')
@@ -0,0 +1,347 @@
+"""ASGI entry point with an async read path.
+
+    pip install aiosqlite uvicorn
+    uvicorn asgi:application
+
+home, book_page, read_chapter and sitemap are served by coroutines that read
+through a fixed pool of read-only aiosqlite connections, so a slow client
+costs a suspended task instead of a thread. Every other route runs the Flask
+app as usual in a worker thread and keeps using db.session.
+"""
+import asyncio
+import io
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from types import SimpleNamespace
+from urllib.request import pathname2url
+
+import aiosqlite
+from flask import Response, make_response, render_template
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException, NotFound, RequestEntityTooLarge
+
+from app import app, database_path, generation_watcher, render_chapter, OFFLINE_CHAPTERS_AHEAD
+from db_restore import GenerationWatcher
+from extensions import db
+from models import Book, Chapter, Review
+
+READER_POOL_SIZE = 4
+
+
+class ReaderPool:
+    """A fixed number of read-only SQLite connections shared by the async views.
+
+    Connections are opened on first use. dispose() (called by
+    GenerationWatcher after a restore) makes each connection reopen the
+    new database file the next time it is checked out.
+    """
+
+    def __init__(self, db_path, size=READER_POOL_SIZE):
+        self.db_path = db_path
+        self.generation = 0
+        self._idle = asyncio.Queue()
+        for _ in range(size):
+            self._idle.put_nowait((None, None))
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(f'file:{pathname2url(self.db_path)}?mode=ro', uri=True)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def dispose(self):
+        self.generation += 1
+
+    @asynccontextmanager
+    async def connection(self):
+        generation, conn = await self._idle.get()
+        try:
+            if conn is None or generation != self.generation:
+                if conn is not None:
+                    await conn.close()
+                    conn = None
+                conn = await self._connect()
+                generation = self.generation
+            yield conn
+        finally:
+            self._idle.put_nowait((generation, conn))
+
+    async def fetch_all(self, sql, params=()):
+        async with self.connection() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def fetch_one(self, sql, params=()):
+        async with self.connection() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def close(self):
+        for _ in range(self._idle.qsize()):
+            generation, conn = self._idle.get_nowait()
+            if conn is not None:
+                await conn.close()
+            self._idle.put_nowait((None, None))
+
+
+readers = ReaderPool(database_path)
+reader_watcher = GenerationWatcher(database_path)
+
+
+def _columns(model, *exclude):
+    """SELECT list for every column of `model`, so templates see the same fields the ORM views load."""
+    return ', '.join(column.name for column in model.__table__.columns if column.name not in exclude)
+
+
+BOOK_COLUMNS = _columns(Book)
+CHAPTER_COLUMNS = _columns(Chapter)
+# Chapter lists and prev/next links never show the text.
+CHAPTER_LIST_COLUMNS = _columns(Chapter, 'content')
+REVIEW_COLUMNS = _columns(Review)
+
+
+def _record(row, model):
+    """A sqlite3.Row as an attribute object, with values converted back to the types `model` declares."""
+    if row is None:
+        return None
+    data = dict(row)
+    for column in model.__table__.columns:
+        value = data.get(column.name)
+        if value is None:
+            continue
+        if isinstance(column.type, db.DateTime):
+            data[column.name] = datetime.fromisoformat(value)
+        elif isinstance(column.type, db.Date):
+            data[column.name] = date.fromisoformat(value)
+        elif isinstance(column.type, db.Boolean):
+            data[column.name] = bool(value)
+    return SimpleNamespace(**data)
+
+
+def build_environ(scope, body=None):
+    """A WSGI environ for `scope`, so the Flask request context (session, url_for, templates) works."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body if body is not None else io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+def _load_current_user():
+    # asyncio.to_thread copies the request context into the worker thread, so
+    # Flask-Login reads the session and remember-me cookie and calls the
+    # user_loader exactly as it does for the Flask routes.
+    generation_watcher.check(db.engine)
+    return current_user._get_current_object()
+
+
+async def load_current_user():
+    """Load flask_login's current_user for this request without blocking the event loop."""
+    return await asyncio.to_thread(_load_current_user)
+
+
+async def home(environ):
+    with app.request_context(environ):
+        _, rows = await asyncio.gather(
+            load_current_user(),
+            readers.fetch_all(f'SELECT {BOOK_COLUMNS} FROM book ORDER BY created_at DESC'),
+        )
+        books = [_record(row, Book) for row in rows]
+        return app.process_response(make_response(render_template('home.html', books=books)))
+
+
+async def book_page(environ, book_id):
+    with app.request_context(environ):
+        _, book, chapters, reviews = await asyncio.gather(
+            load_current_user(),
+            readers.fetch_one(f'SELECT {BOOK_COLUMNS} FROM book WHERE id = ?', (book_id,)),
+            readers.fetch_all(f'SELECT {CHAPTER_LIST_COLUMNS} FROM chapter '
+                              'WHERE book_id = ? ORDER BY chapter_number', (book_id,)),
+            readers.fetch_all(f'SELECT {REVIEW_COLUMNS} FROM review '
+                              'WHERE book_id = ? AND approved = 1 ORDER BY created_at DESC', (book_id,)),
+        )
+        if book is None:
+            return NotFound().get_response(environ)
+        book = _record(book, Book)
+        book.chapters = [_record(row, Chapter) for row in chapters]
+        reviews = [_record(row, Review) for row in reviews]
+        return app.process_response(make_response(render_template('book_page.html', book=book, reviews=reviews)))
+
+
+async def read_chapter(environ, book_id, chapter_id):
+    with app.request_context(environ):
+        _, book, chapter = await asyncio.gather(
+            load_current_user(),
+            readers.fetch_one(f'SELECT {BOOK_COLUMNS} FROM book WHERE id = ?', (book_id,)),
+            readers.fetch_one(f'SELECT {CHAPTER_COLUMNS} FROM chapter WHERE id = ?', (chapter_id,)),
+        )
+        if book is None or chapter is None:
+            return NotFound().get_response(environ)
+        book = _record(book, Book)
+        chapter = _record(chapter, Chapter)
+
+        upcoming, prev_chapter = await asyncio.gather(
+            readers.fetch_all('SELECT id, updated_at FROM chapter WHERE book_id = ? AND chapter_number > ? '
+                              'ORDER BY chapter_number LIMIT ?', (book_id, chapter.chapter_number, OFFLINE_CHAPTERS_AHEAD)),
+            readers.fetch_one(f'SELECT {CHAPTER_LIST_COLUMNS} FROM chapter WHERE book_id = ? AND chapter_number < ? '
+                              'ORDER BY chapter_number DESC LIMIT 1', (book_id, chapter.chapter_number)),
+        )
+        upcoming = [_record(row, Chapter) for row in upcoming]
+        return app.process_response(render_chapter(book, chapter, _record(prev_chapter, Chapter), upcoming))
+
+
+def _read_sitemap():
+    with open(os.path.join(app.root_path, 'sitemap.xml'), 'rb') as f:
+        return f.read()
+
+
+async def sitemap(environ):
+    return Response(await asyncio.to_thread(_read_sitemap), mimetype='application/xml')
+
+
+ROUTES = [
+    (re.compile(r'^/$'), home),
+    (re.compile(r'^/books/(?P<book_id>\d+)$'), book_page),
+    (re.compile(r'^/books/(?P<book_id>\d+)/chapters/(?P<chapter_id>\d+)$'), read_chapter),
+    (re.compile(r'^/sitemap\.xml$'), sitemap),
+]
+
+
+async def send_response(send, response, head=False):
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.headers.items()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': b'' if head else response.get_data()})
+
+
+def body_limit(scope):
+    """The MAX_CONTENT_LENGTH Flask will apply to this request; restore_database raises its own."""
+    try:
+        endpoint, _ = app.url_map.bind('localhost').match(scope['path'], method=scope['method'])
+    except HTTPException:
+        endpoint = None
+    if endpoint == 'restore_database':
+        return app.config['RESTORE_MAX_CONTENT_LENGTH']
+    return app.config['MAX_CONTENT_LENGTH']
+
+
+async def read_body(scope, receive, limit):
+    """The request body in a spool file and its size, or (None, size) once it exceeds `limit`."""
+    declared = dict(scope['headers']).get(b'content-length')
+    if declared is not None and declared.isdigit() and int(declared) > limit:
+        return None, int(declared)
+    # Anything larger than an ordinary form goes to disk instead of memory.
+    body = tempfile.SpooledTemporaryFile(max_size=app.config['MAX_CONTENT_LENGTH'])
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            body.close()
+            return None, size
+        body.write(chunk)
+        more_body = message.get('more_body', False)
+    body.seek(0)
+    return body, size
+
+
+async def call_flask(scope, receive, send):
+    """Serve any other route with the Flask app in a worker thread, streaming its response."""
+    body, size = await read_body(scope, receive, body_limit(scope))
+    if body is None:
+        # Refused before Flask sees it, so an oversized body is never held in full.
+        response = RequestEntityTooLarge().get_response(build_environ(scope))
+        await send_response(send, response, head=scope['method'] == 'HEAD')
+        return
+
+    environ = build_environ(scope, body)
+    # A chunked upload has no Content-Length, which Werkzeug needs to read the body.
+    environ.setdefault('CONTENT_LENGTH', str(size))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    result = await asyncio.to_thread(app, environ, start_response)
+    chunks = iter(result)
+    try:
+        # Werkzeug calls start_response before returning, but a WSGI app may defer it to the first chunk.
+        first = await asyncio.to_thread(next, chunks, None)
+        await send({
+            'type': 'http.response.start',
+            'status': started['status'],
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in started['headers']],
+        })
+        chunk = first
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await asyncio.to_thread(next, chunks, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await asyncio.to_thread(result.close)
+        body.close()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await readers.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        for pattern, view in ROUTES:
+            match = pattern.match(scope['path'])
+            if match:
+                reader_watcher.check(readers)
+                kwargs = {name: int(value) for name, value in match.groupdict().items()}
+                response = await view(build_environ(scope), **kwargs)
+                await send_response(send, response, head=scope['method'] == 'HEAD')
+                return
+
+    if scope['type'] == 'http':
+        await call_flask(scope, receive, send)
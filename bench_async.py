@@ -0,0 +1,172 @@
+"""Concurrency benchmark for the read path.
+
+Starts the app pinned to a single CPU core and measures throughput and
+latency of read_chapter as the number of concurrent readers grows.
+
+    pip install aiosqlite uvicorn
+    python bench_async.py                  # asgi.py under uvicorn
+    python bench_async.py --server wsgi    # Flask's threaded server, for comparison
+
+Uses the first chapter in instance/books.db, so add a book with a chapter first.
+The load generator is a bare keep-alive HTTP/1.1 client so that, when it has to
+share the server's core, it takes as little of it as possible.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, 'instance', 'books.db')
+REQUEST_TIMEOUT = 30
+
+
+def first_chapter_url():
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        row = conn.execute('SELECT book_id, id FROM chapter ORDER BY book_id, chapter_number LIMIT 1').fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        sys.exit('No chapters found. Add a book with at least one chapter first.')
+    return f'/books/{row[0]}/chapters/{row[1]}'
+
+
+def start_server(kind, port, cpu):
+    if kind == 'asgi':
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(port),
+               '--log-level', 'warning', '--no-access-log']
+    else:
+        cmd = [sys.executable, '-c', f'from app import app; app.run(port={port}, threaded=True)']
+
+    def pin():
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, {cpu})
+
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, preexec_fn=pin,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                sys.exit(f'{kind} server exited during startup')
+            time.sleep(0.1)
+    proc.kill()
+    sys.exit(f'{kind} server did not start on port {port}')
+
+
+async def get(reader, writer, request):
+    """One GET on an open connection; returns the status code and whether the server keeps it open."""
+    writer.write(request)
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    status_line, *header_lines = head.decode('latin-1').split('\r\n')
+    headers = dict(line.lower().split(': ', 1) for line in header_lines if line)
+    if 'content-length' not in headers:
+        raise ValueError('response without Content-Length')
+    await reader.readexactly(int(headers['content-length']))
+    return int(status_line.split(' ', 2)[1]), headers.get('connection', '').lower() != 'close'
+
+
+async def run_level(url, concurrency, duration):
+    parts = urlsplit(url)
+    request = (f'GET {parts.path} HTTP/1.1\r\nHost: {parts.netloc}\r\n'
+               'Connection: keep-alive\r\n\r\n').encode('latin-1')
+    latencies = []
+    errors = 0
+    stop_at = time.perf_counter() + duration
+
+    async def client():
+        nonlocal errors
+        reader = writer = None
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(parts.hostname, parts.port)
+                status, keep_alive = await asyncio.wait_for(get(reader, writer, request), REQUEST_TIMEOUT)
+            except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                errors += 1
+                if writer is not None:
+                    writer.close()
+                reader = writer = None
+                continue
+            if not keep_alive:
+                # Flask's dev server answers every request with Connection: close.
+                writer.close()
+                reader = writer = None
+            if status != 200:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+        if writer is not None:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else float('nan')
+
+    return {
+        'concurrency': concurrency,
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(0.50),
+        'p95': percentile(0.95),
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=['asgi', 'wsgi'], default='asgi')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--levels', default='1,10,50,100,250', help='comma-separated concurrent reader counts')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per level')
+    parser.add_argument('--p95-target', type=float, default=500.0, help='latency budget in ms for the summary')
+    args = parser.parse_args()
+
+    server_cpu = 0
+    shared_core = True
+    # Keep the load generator off the server's core when there is another one.
+    if hasattr(os, 'sched_setaffinity') and len(os.sched_getaffinity(0)) > 1:
+        server_cpu = min(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, os.sched_getaffinity(0) - {server_cpu})
+        shared_core = False
+
+    url = f'http://127.0.0.1:{args.port}{first_chapter_url()}'
+    proc = start_server(args.server, args.port, server_cpu)
+    try:
+        print(f'{args.server} server on one core, GET {url}')
+        if shared_core:
+            print('Only one core available: the load generator shares it, so these numbers are a lower bound.')
+        print(f"{'readers':>8} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'errors':>7}")
+        best = None
+        for level in (int(n) for n in args.levels.split(',')):
+            result = asyncio.run(run_level(url, level, args.duration))
+            print(f"{result['concurrency']:>8} {result['rps']:>9.1f} {result['p50']:>9.1f} {result['p95']:>9.1f} {result['errors']:>7}")
+            if not result['errors'] and result['p95'] <= args.p95_target:
+                best = result
+        if best:
+            print(f"Sustains {best['concurrency']} concurrent readers at {best['rps']:.0f} req/s "
+                  f"with p95 under {args.p95_target:.0f} ms.")
+        else:
+            print(f'No level met the p95 target of {args.p95_target:.0f} ms.')
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 from app import app
-from models import db
+from models import db, Book, rebuild_chapter_index
 
 with app.app_context():
     db.create_all()
+    for book in Book.query.all():
+        rebuild_chapter_index(book.id)
+    db.session.commit()
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import tempfile
+import threading
+
+from sqlalchemy import create_engine
+
+# How long a restore waits for in-flight requests to release the database.
+SWAP_LOCK_TIMEOUT = 30
+
+
+class RestoreError(Exception):
+    pass
+
+
+def validate_database(path, metadata, required_tables):
+    """Check that `path` is a healthy SQLite database the models can use.
+
+    Tables the models know about must have every mapped column, and
+    `required_tables` must exist. Tables added since the backup was taken
+    are created so the restored file is immediately usable.
+    """
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            result = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+            if result != ['ok']:
+                raise RestoreError('Integrity check failed: ' + '; '.join(result[:5]))
+
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            missing_tables = set(required_tables) - tables
+            if missing_tables:
+                raise RestoreError(f"Backup is missing tables: {', '.join(sorted(missing_tables))}")
+
+            for table in metadata.sorted_tables:
+                if table.name not in tables:
+                    continue
+                columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{table.name}")')}
+                missing_columns = {column.name for column in table.columns} - columns
+                if missing_columns:
+                    raise RestoreError(f"Table '{table.name}' is missing columns: {', '.join(sorted(missing_columns))}")
+
+            # A WAL-mode file would pick up the live database's -wal file after the swap.
+            conn.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as e:
+        raise RestoreError(f'Not a valid SQLite database: {e}')
+
+    engine = create_engine('sqlite:///' + path)
+    try:
+        metadata.create_all(engine)
+    finally:
+        engine.dispose()
+
+
+def swap_database(new_path, db_path, timeout=SWAP_LOCK_TIMEOUT):
+    """Atomically replace db_path with new_path and signal every worker.
+
+    An exclusive lock on the live database waits for running transactions to
+    finish, so no journal is left half-written when the file is replaced.
+    Connections that are already open keep the old file until they close.
+    """
+    conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+    try:
+        try:
+            conn.execute('BEGIN EXCLUSIVE')
+        except sqlite3.OperationalError as e:
+            raise RestoreError(f'Live database is busy, try again: {e}')
+        os.replace(new_path, db_path)
+        conn.execute('ROLLBACK')
+    finally:
+        conn.close()
+    return bump_generation(db_path)
+
+
+def _generation_path(db_path):
+    return db_path + '.generation'
+
+
+def read_generation(db_path):
+    try:
+        with open(_generation_path(db_path)) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def bump_generation(db_path):
+    """Write generation + 1 via rename, so watchers see a new inode."""
+    generation = read_generation(db_path) + 1
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(db_path), suffix='.generation')
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(generation))
+    os.replace(tmp_path, _generation_path(db_path))
+    return generation
+
+
+class GenerationWatcher:
+    """Disposes an engine's connection pool when another worker swaps the database.
+
+    check() costs one stat() call, so it is cheap enough to run before every request.
+    """
+
+    def __init__(self, db_path):
+        self.path = _generation_path(db_path)
+        self._seen = self._stamp()
+        self._lock = threading.Lock()
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def check(self, engine):
+        stamp = self._stamp()
+        if stamp == self._seen:
+            return False
+        with self._lock:
+            if stamp == self._seen:
+                return False
+            # Checked-out connections are left to finish on the old file;
+            # they are closed when returned instead of going back in the pool.
+            engine.dispose()
+            self._seen = stamp
+        return True
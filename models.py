@@ -51,6 +51,9 @@ class Chapter(db.Model):
         db.UniqueConstraint('book_id', 'chapter_number', name='unique_chapter_number'),
     )
 
+    ordinal = db.relationship('ChapterOrdinal', uselist=False, viewonly=True)
+    revisions = db.relationship('ChapterRevision', lazy='dynamic', cascade='all, delete-orphan', order_by='ChapterRevision.revision')
+
     def to_dict_simple(self):
         return {
             'id': self.id,
@@ -74,6 +77,56 @@ class Chapter(db.Model):
     def __repr__(self):
         return f'<Chapter {self.chapter_number}: {self.title}>'
 
+class ChapterOrdinal(db.Model):
+    """Position of each chapter within its book, kept up to date by rebuild_chapter_index."""
+    __tablename__ = 'chapter_ordinal'
+    chapter_id = db.Column(db.Integer, db.ForeignKey('chapter.id'), primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False, index=True)
+    ordinal = db.Column(db.Integer, nullable=False)
+    chapter_count = db.Column(db.Integer, nullable=False)
+
+    @property
+    def percent(self):
+        if not self.chapter_count:
+            return 0
+        return round(self.ordinal * 100 / self.chapter_count)
+
+def rebuild_chapter_index(book_id):
+    """Renumber a book's chapters 1..n. Call after adding, renumbering or deleting chapters; the caller commits."""
+    chapter_ids = [row.id for row in db.session.query(Chapter.id)
+                   .filter(Chapter.book_id == book_id)
+                   .order_by(Chapter.chapter_number).all()]
+    ChapterOrdinal.query.filter_by(book_id=book_id).delete(synchronize_session='fetch')
+    db.session.add_all([
+        ChapterOrdinal(chapter_id=chapter_id, book_id=book_id, ordinal=position, chapter_count=len(chapter_ids))
+        for position, chapter_id in enumerate(chapter_ids, start=1)
+    ])
+
+class ChapterRevision(db.Model):
+    """One saved version of a chapter's content. See revisions.py for the storage format."""
+    __tablename__ = 'chapter_revision'
+    id = db.Column(db.Integer, primary_key=True)
+    chapter_id = db.Column(db.Integer, db.ForeignKey('chapter.id'), nullable=False)
+    revision = db.Column(db.Integer, nullable=False)
+    # 'snapshot': zlib-compressed full text; 'delta': zlib-compressed JSON edit ops against revision - 1
+    kind = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=current_time)
+
+    __table_args__ = (
+        db.UniqueConstraint('chapter_id', 'revision', name='unique_chapter_revision'),
+    )
+
+    def to_dict(self):
+        return {
+            'revision': self.revision,
+            'kind': self.kind,
+            'stored_bytes': len(self.data),
+            'user_id': self.user_id,
+            'created_at': self.created_at.isoformat(),
+        }
+
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
@@ -129,4 +182,72 @@ class ReadingProgress(db.Model):
     last_read_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     book = db.relationship('Book')
-    chapter = db.relationship('Chapter')
\ No newline at end of file
+    chapter = db.relationship('Chapter')
+
+    @property
+    def percent_complete(self):
+        if self.chapter is None or self.chapter.ordinal is None:
+            return None
+        return self.chapter.ordinal.percent
+
+class ReadingEvent(db.Model):
+    """Append-only log of chapter reads, folded into the *Stats tables by analytics.rollup_reading_events."""
+    __tablename__ = 'reading_event'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    chapter_id = db.Column(db.Integer, db.ForeignKey('chapter.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# First-seen markers used by the rollup to count distinct readers.
+class ReaderChapter(db.Model):
+    __tablename__ = 'reader_chapter'
+    user_id = db.Column(db.Integer, primary_key=True)
+    chapter_id = db.Column(db.Integer, primary_key=True)
+
+class ReaderBook(db.Model):
+    __tablename__ = 'reader_book'
+    user_id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, primary_key=True)
+
+class ReaderBookDay(db.Model):
+    __tablename__ = 'reader_book_day'
+    user_id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+
+class ReaderDay(db.Model):
+    __tablename__ = 'reader_day'
+    user_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+
+class BookStats(db.Model):
+    __tablename__ = 'book_stats'
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), primary_key=True)
+    readers = db.Column(db.Integer, nullable=False, default=0)
+    reads = db.Column(db.Integer, nullable=False, default=0)
+
+class BookDayStats(db.Model):
+    __tablename__ = 'book_day_stats'
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    readers = db.Column(db.Integer, nullable=False, default=0)
+    reads = db.Column(db.Integer, nullable=False, default=0)
+
+class ChapterStats(db.Model):
+    __tablename__ = 'chapter_stats'
+    chapter_id = db.Column(db.Integer, db.ForeignKey('chapter.id'), primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False, index=True)
+    readers = db.Column(db.Integer, nullable=False, default=0)
+    reads = db.Column(db.Integer, nullable=False, default=0)
+
+class DailyStats(db.Model):
+    __tablename__ = 'daily_stats'
+    day = db.Column(db.Date, primary_key=True)
+    active_readers = db.Column(db.Integer, nullable=False, default=0)
+    reads = db.Column(db.Integer, nullable=False, default=0)
+
+class RollupState(db.Model):
+    __tablename__ = 'rollup_state'
+    name = db.Column(db.String(50), primary_key=True)
+    last_event_id = db.Column(db.Integer, nullable=False, default=0)
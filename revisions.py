@@ -0,0 +1,120 @@
+import json
+import zlib
+
+from extensions import db
+from models import ChapterRevision
+
+# Every Nth revision stores the full text, so rebuilding any version applies
+# at most N - 1 deltas.
+SNAPSHOT_INTERVAL = 20
+
+
+class RevisionConflict(Exception):
+    def __init__(self, current):
+        super().__init__(f'Chapter has changed since revision was loaded (now at revision {current}).')
+        self.current = current
+
+
+class InvalidDelta(Exception):
+    pass
+
+
+def current_revision(chapter_id):
+    """Latest revision number, or 0 for a chapter with no recorded history."""
+    return db.session.query(db.func.max(ChapterRevision.revision))\
+        .filter(ChapterRevision.chapter_id == chapter_id).scalar() or 0
+
+
+def normalize_newlines(text):
+    """Browsers submit textareas with CRLF line endings but edit them with LF; content is stored with LF only."""
+    return (text or '').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def diff_text(old, new):
+    """Edit ops turning `old` into `new`: one splice covering everything between the common prefix and suffix."""
+    start = 0
+    limit = min(len(old), len(new))
+    while start < limit and old[start] == new[start]:
+        start += 1
+    old_end, new_end = len(old), len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    if start == old_end and start == new_end:
+        return []
+    return [{'pos': start, 'delete': old_end - start, 'insert': new[start:new_end]}]
+
+
+def apply_delta(text, ops):
+    """Apply edit ops in order. Positions count characters in the text as it stands before each op."""
+    if not isinstance(ops, list):
+        raise InvalidDelta('ops must be a list')
+    for op in ops:
+        try:
+            pos, delete, insert = op['pos'], op.get('delete', 0), op.get('insert', '')
+        except (TypeError, KeyError):
+            raise InvalidDelta('each op needs a pos')
+        if not (isinstance(pos, int) and isinstance(delete, int) and isinstance(insert, str)):
+            raise InvalidDelta('pos and delete must be integers and insert a string')
+        if pos < 0 or delete < 0 or pos + delete > len(text):
+            raise InvalidDelta(f'op at {pos} deleting {delete} is outside the text ({len(text)} characters)')
+        text = text[:pos] + insert + text[pos + delete:]
+    return text
+
+
+def _add_revision(chapter_id, revision, text, ops, user_id):
+    if ops is None or revision % SNAPSHOT_INTERVAL == 0:
+        kind, payload = 'snapshot', text
+    else:
+        kind, payload = 'delta', json.dumps(ops, separators=(',', ':'))
+    db.session.add(ChapterRevision(chapter_id=chapter_id, revision=revision, kind=kind,
+                                   data=zlib.compress(payload.encode('utf-8')), user_id=user_id))
+
+
+def save_content(chapter, base_revision, ops, user_id=None):
+    """Apply `ops` to the chapter if it is still at `base_revision` and record the new revision.
+
+    Positions in `ops` refer to the content with normalized newlines.
+    Raises RevisionConflict if someone else saved first. The caller commits;
+    a concurrent save that slips past the check fails on the unique
+    (chapter_id, revision) constraint at commit instead.
+    """
+    current = current_revision(chapter.id)
+    if base_revision != current:
+        raise RevisionConflict(current)
+    old_content = chapter.content or ''
+    base = normalize_newlines(old_content)
+    applied = apply_delta(base, ops)
+    new_content = normalize_newlines(applied)
+    if new_content == base:
+        return current
+
+    if current == 0:
+        # Start the history with the text as it was before tracking began.
+        _add_revision(chapter.id, 0, old_content, None, user_id)
+    chapter.content = new_content
+    # Text stored before newlines were normalized, or ops inserting \r, aren't
+    # described exactly by `ops`, so that revision is kept as a snapshot.
+    exact = base == old_content and applied == new_content
+    _add_revision(chapter.id, current + 1, new_content, ops if exact else None, user_id)
+    return current + 1
+
+
+def rebuild(chapter_id, revision):
+    """Text of the chapter at `revision`, from the nearest snapshot plus the deltas after it."""
+    snapshot = ChapterRevision.query.filter(ChapterRevision.chapter_id == chapter_id,
+                                            ChapterRevision.revision <= revision,
+                                            ChapterRevision.kind == 'snapshot')\
+        .order_by(ChapterRevision.revision.desc()).first()
+    if snapshot is None:
+        return None
+    text = zlib.decompress(snapshot.data).decode('utf-8')
+    deltas = ChapterRevision.query.filter(ChapterRevision.chapter_id == chapter_id,
+                                          ChapterRevision.revision > snapshot.revision,
+                                          ChapterRevision.revision <= revision)\
+        .order_by(ChapterRevision.revision).all()
+    if len(deltas) != revision - snapshot.revision:
+        return None
+    for delta in deltas:
+        text = apply_delta(text, json.loads(zlib.decompress(delta.data)))
+    return text
@@ -0,0 +1,14 @@
+from app import app
+from analytics import rollup_reading_events
+
+def run_rollup():
+    """
+    Folds new reading events into the analytics tables.
+    Run this from cron (e.g. every few minutes) to keep the admin dashboard current.
+    """
+    with app.app_context():
+        folded = rollup_reading_events()
+        print(f"Rolled up {folded} reading event(s).")
+
+if __name__ == '__main__':
+    run_rollup()
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+
+# 64 KiB is a whole number of SQLite pages for every page size up to the
+# default maximum, so an unchanged run of pages always produces the same chunk.
+CHUNK_SIZE = 64 * 1024
+
+# Chunks written more recently than this are never collected, so a backup
+# that is still writing its chunks cannot lose them to a concurrent prune.
+GC_GRACE_SECONDS = 60 * 60
+
+SNAPSHOT_NAME = re.compile(r'^backup_\d{8}_\d{6}(_\d+)?$')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotStore:
+    """Deduplicated database backups.
+
+    The database is split into fixed-size chunks stored once under
+    chunks/<sha256>, and each backup is a small JSON manifest listing its
+    chunks in order. A new backup only writes the chunks that changed.
+    """
+
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.chunk_dir = os.path.join(root, 'chunks')
+        self.manifest_dir = os.path.join(root, 'manifests')
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def _manifest_path(self, name):
+        if not SNAPSHOT_NAME.match(name):
+            raise SnapshotError(f'Invalid snapshot name: {name}')
+        return os.path.join(self.manifest_dir, name + '.json')
+
+    def _write_atomic(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _new_name(self, created_at):
+        base = f"backup_{created_at.strftime('%Y%m%d_%H%M%S')}"
+        name, n = base, 1
+        while os.path.exists(self._manifest_path(name)):
+            name = f'{base}_{n}'
+            n += 1
+        return name
+
+    def create(self, db_path):
+        """Snapshot a live SQLite database and return its manifest."""
+        created_at = datetime.now()
+        fd, copy_path = tempfile.mkstemp(dir=self.root, suffix='.db')
+        os.close(fd)
+        try:
+            # The backup API gives a consistent copy even while other
+            # connections are writing, unlike copying the file directly.
+            src = sqlite3.connect(db_path)
+            dst = sqlite3.connect(copy_path)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+                src.close()
+
+            chunks = []
+            size = 0
+            new_bytes = 0
+            with open(copy_path, 'rb') as f:
+                while True:
+                    block = f.read(self.chunk_size)
+                    if not block:
+                        break
+                    digest = hashlib.sha256(block).hexdigest()
+                    path = self._chunk_path(digest)
+                    if os.path.exists(path):
+                        os.utime(path)
+                    else:
+                        stored = zlib.compress(block)
+                        self._write_atomic(path, stored)
+                        new_bytes += len(stored)
+                    chunks.append(digest)
+                    size += len(block)
+        finally:
+            os.remove(copy_path)
+
+        manifest = {
+            'name': self._new_name(created_at),
+            'created_at': created_at.isoformat(),
+            'size': size,
+            'chunk_size': self.chunk_size,
+            'new_bytes': new_bytes,
+            'chunks': chunks,
+        }
+        self._write_atomic(self._manifest_path(manifest['name']),
+                           json.dumps(manifest).encode('utf-8'))
+        return manifest
+
+    def load(self, name):
+        path = self._manifest_path(name)
+        if not os.path.exists(path):
+            raise SnapshotError(f'Snapshot not found: {name}')
+        with open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def list(self):
+        """All manifests, newest first."""
+        manifests = []
+        for filename in os.listdir(self.manifest_dir):
+            name, ext = os.path.splitext(filename)
+            if ext == '.json' and SNAPSHOT_NAME.match(name):
+                manifests.append(self.load(name))
+        manifests.sort(key=lambda m: m['created_at'], reverse=True)
+        return manifests
+
+    def restore(self, name, dest_path):
+        """Rebuild a snapshot into dest_path, verifying every chunk."""
+        manifest = self.load(name)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest_path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for digest in manifest['chunks']:
+                    path = self._chunk_path(digest)
+                    if not os.path.exists(path):
+                        raise SnapshotError(f'Snapshot {name} is missing chunk {digest}')
+                    with open(path, 'rb') as f:
+                        block = zlib.decompress(f.read())
+                    if hashlib.sha256(block).hexdigest() != digest:
+                        raise SnapshotError(f'Snapshot {name} has a corrupt chunk {digest}')
+                    out.write(block)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return manifest
+
+    def delete(self, name):
+        os.remove(self._manifest_path(name))
+
+    def prune(self, daily=7, weekly=4, monthly=12, recent_hours=24):
+        """Apply grandfather-father-son retention, then collect unused chunks.
+
+        Keeps every snapshot from the last `recent_hours`, then the newest
+        snapshot of each of the last `daily` days, `weekly` ISO weeks and
+        `monthly` months that have backups. Returns the names of the deleted
+        snapshots.
+        """
+        manifests = self.list()
+        keep = select_retained(manifests, daily, weekly, monthly, recent_hours)
+        removed = []
+        for manifest in manifests:
+            if manifest['name'] not in keep:
+                self.delete(manifest['name'])
+                removed.append(manifest['name'])
+        self.collect_garbage()
+        return removed
+
+    def collect_garbage(self):
+        """Delete chunks no manifest refers to. Returns bytes freed."""
+        referenced = set()
+        for manifest in self.list():
+            referenced.update(manifest['chunks'])
+        cutoff = time.time() - GC_GRACE_SECONDS
+        freed = 0
+        for prefix in os.listdir(self.chunk_dir):
+            prefix_dir = os.path.join(self.chunk_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for digest in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, digest)
+                if digest in referenced or os.path.getmtime(path) > cutoff:
+                    continue
+                freed += os.path.getsize(path)
+                os.remove(path)
+        return freed
+
+    def disk_usage(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+        return total
+
+
+def select_retained(manifests, daily, weekly, monthly, recent_hours=24, now=None):
+    """Names to keep from `manifests` (newest first) under GFS retention.
+
+    Snapshots from the last `recent_hours` are all kept, so a backup taken
+    before a risky change survives the next one taken the same day.
+    """
+    recent_since = (now or datetime.now()) - timedelta(hours=recent_hours)
+    periods = [
+        (daily, lambda t: t.date()),
+        (weekly, lambda t: tuple(t.isocalendar()[:2])),
+        (monthly, lambda t: (t.year, t.month)),
+    ]
+    keep = {manifest['name'] for manifest in manifests
+            if datetime.fromisoformat(manifest['created_at']) >= recent_since}
+    if manifests:
+        keep.add(manifests[0]['name'])
+    for limit, period_of in periods:
+        seen = set()
+        for manifest in manifests:
+            period = period_of(datetime.fromisoformat(manifest['created_at']))
+            if period in seen:
+                continue
+            if len(seen) >= limit:
+                break
+            seen.add(period)
+            keep.add(manifest['name'])
+    return keep
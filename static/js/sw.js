@@ -0,0 +1,135 @@
+// Offline reading: keeps chapters the reader has opened, plus the next few,
+// so page turns are served locally and still work without a network.
+const CHAPTER_CACHE = 'bookclub-chapters-v2';
+// The version of each chapter as last listed by a chapter page. Kept in a
+// cache rather than in memory because the worker is stopped while idle.
+const VERSION_CACHE = 'bookclub-chapter-versions-v1';
+const STATIC_CACHE = 'bookclub-static-v2';
+const MAX_CACHED_CHAPTERS = 200;
+const MAX_CACHED_STATIC = 50;
+const CHAPTER_PATH = /^\/books\/\d+\/chapters\/\d+$/;
+// Only the app's own CSS and JS; uploaded covers are left to the HTTP cache.
+const STATIC_PATH = /^\/static\/(css|js)\//;
+const LOGOUT_PATH = '/logout';
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys
+                .filter(key => ![CHAPTER_CACHE, VERSION_CACHE, STATIC_CACHE].includes(key))
+                .map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+// read_chapter.html posts the current and upcoming chapters with their updated_at.
+self.addEventListener('message', (event) => {
+    if (event.data && event.data.type === 'cache-chapters') {
+        const chapters = event.data.chapters;
+        event.waitUntil(rememberVersions(chapters).then(() => cacheChapters(chapters)));
+    }
+});
+
+self.addEventListener('fetch', (event) => {
+    const url = new URL(event.request.url);
+    if (event.request.method !== 'GET' || url.origin !== self.location.origin) return;
+
+    if (url.pathname === LOGOUT_PATH) {
+        // Cached pages carry the signed-in reader's navigation; don't leave them for the next one.
+        event.waitUntil(Promise.all([caches.delete(CHAPTER_CACHE), caches.delete(VERSION_CACHE)]));
+    } else if (CHAPTER_PATH.test(url.pathname)) {
+        event.respondWith(chapterResponse(event));
+    } else if (STATIC_PATH.test(url.pathname)) {
+        event.respondWith(staticResponse(event));
+    }
+});
+
+async function rememberVersions(chapters) {
+    const versions = await caches.open(VERSION_CACHE);
+    for (const { url, version } of chapters) {
+        await versions.put(url, new Response(version));
+    }
+    await trimCache(versions, MAX_CACHED_CHAPTERS);
+}
+
+async function listedVersion(url) {
+    const entry = await caches.match(url, { cacheName: VERSION_CACHE });
+    return entry ? entry.text() : null;
+}
+
+async function cacheChapters(chapters) {
+    for (const { url, version, prefetched } of chapters) {
+        // The page's Link header already prefetches this one, and that request
+        // comes through chapterResponse, which stores it.
+        if (prefetched) continue;
+        const cached = await caches.match(url, { cacheName: CHAPTER_CACHE });
+        if (cached && cached.headers.get('X-Chapter-Version') === version) continue;
+        try {
+            await fetchChapter(url);
+        } catch (e) {
+            // Offline: the next page view will try again.
+        }
+    }
+}
+
+// A cached copy at the version the previous page listed is served straight
+// away and refreshed in the background. Anything else goes to the network,
+// falling back to the cached copy when offline. The page posts reading
+// progress itself, so a locally served page still counts.
+async function chapterResponse(event) {
+    const url = event.request.url;
+    const [cached, listed] = await Promise.all([
+        caches.match(url, { cacheName: CHAPTER_CACHE }),
+        listedVersion(url)
+    ]);
+    if (cached && listed && cached.headers.get('X-Chapter-Version') === listed) {
+        event.waitUntil(fetchChapter(url).catch(() => {}));
+        return cached;
+    }
+    try {
+        const response = await fetch(event.request);
+        if (response.ok) event.waitUntil(storeChapter(url, response.clone()));
+        return response;
+    } catch (e) {
+        if (cached) return cached;
+        throw e;
+    }
+}
+
+async function fetchChapter(url) {
+    const response = await fetch(url, { credentials: 'same-origin' });
+    if (response.ok) await storeChapter(url, response);
+}
+
+async function storeChapter(url, response) {
+    const cache = await caches.open(CHAPTER_CACHE);
+    await cache.put(url, response);
+    await trimCache(cache, MAX_CACHED_CHAPTERS);
+}
+
+// Stale-while-revalidate: static URLs aren't versioned, so refresh in the background.
+function staticResponse(event) {
+    const network = fetch(event.request).then(response => {
+        if (response.ok) {
+            const copy = response.clone();
+            event.waitUntil(caches.open(STATIC_CACHE).then(async cache => {
+                await cache.put(event.request, copy);
+                await trimCache(cache, MAX_CACHED_STATIC);
+            }));
+        }
+        return response;
+    });
+    event.waitUntil(network.catch(() => {}));
+
+    return caches.match(event.request, { cacheName: STATIC_CACHE })
+        .then(cached => cached || network);
+}
+
+async function trimCache(cache, maxEntries) {
+    const keys = await cache.keys();
+    for (const key of keys.slice(0, Math.max(0, keys.length - maxEntries))) {
+        await cache.delete(key);
+    }
+}